@@ -3,20 +3,26 @@
 Repository: https://github.com/PeWu/appdaemon-machine
 """
 
-from collections import defaultdict, namedtuple
+from collections import defaultdict
 from copy import copy
 from enum import Enum
 from functools import partial
-from urllib.parse import quote
+import operator
 
 
 # Pass ANY as the from_state to add a transition from all possible states.
 ANY = object()
 
 
+def _noop(*unused_args):
+  """Does nothing. Used in place of callbacks that are not set."""
+
+
 class Trigger:
   """Base class for all triggers."""
 
+  __slots__ = ('hass', 'trigger_callback')
+
   def __init__(self):
     self.hass = None
     self.trigger_callback = None
@@ -53,6 +59,8 @@ class Trigger:
 class StateIs(Trigger):
   """A generic state-based trigger."""
 
+  __slots__ = ('entity', 'state_predicate', 'active')
+
   def __init__(self, entity, state_predicate):
     super().__init__()
     self.entity = entity
@@ -86,26 +94,41 @@ class StateIs(Trigger):
 
 class StateEq(StateIs):
   """Trigger when entity state is equal to the given value."""
+
+  __slots__ = ('value',)
+
   def __init__(self, entity, value):
-    super().__init__(entity, lambda v: v == value)
+    super().__init__(entity, partial(operator.eq, value))
     self.value = value
 
+  def _test_predicate(self, entity_state):
+    return entity_state == self.value
+
   def __str__(self):
     return '{} == {}'.format(self.entity, self.value)
 
 
 class StateNeq(StateIs):
   """Trigger when entity state is different than the given value."""
+
+  __slots__ = ('value',)
+
   def __init__(self, entity, value):
-    super().__init__(entity, lambda v: v != value)
+    super().__init__(entity, partial(operator.ne, value))
     self.value = value
 
+  def _test_predicate(self, entity_state):
+    return entity_state != self.value
+
   def __str__(self):
     return '{} != {}'.format(self.entity, self.value)
 
 
 class StateOn(StateEq):
   """Trigger when entity state is on."""
+
+  __slots__ = ()
+
   def __init__(self, entity):
     super().__init__(entity, 'on')
 
@@ -115,6 +138,9 @@ class StateOn(StateEq):
 
 class StateOff(StateNeq):
   """Trigger when entity state is not on."""
+
+  __slots__ = ()
+
   def __init__(self, entity):
     super().__init__(entity, 'on')
 
@@ -125,6 +151,8 @@ class StateOff(StateNeq):
 class Timeout(Trigger):
   """Triggers after a certain time period."""
 
+  __slots__ = ('timeout_sec', 'timer')
+
   def __init__(self, timeout_sec):
     super().__init__()
     self.timeout_sec = timeout_sec
@@ -145,8 +173,16 @@ class Timeout(Trigger):
     return 'timeout {} s'.format(self.timeout_sec)
 
 
-# Internal representation of a transition.
-Transition = namedtuple('Transition', ['trigger', 'to_state', 'on_transition'])
+class Transition:
+  """Internal representation of a transition."""
+
+  __slots__ = ('from_state', 'trigger', 'to_state', 'on_transition')
+
+  def __init__(self, from_state, trigger, to_state, on_transition):
+    self.from_state = from_state
+    self.trigger = trigger
+    self.to_state = to_state
+    self.on_transition = on_transition
 
 
 class Machine:
@@ -173,69 +209,91 @@ class Machine:
     self.hass = hass
     self.states = states
     self.state_entity = entity
+    # Maps state names to states for quick lookup on state entity changes.
+    self._state_names = {s.name: s for s in states}
 
     self.current_state = None
 
     if self.state_entity:
       # Try loading the state from Home Assistant.
       entity_state = self.hass.get_state(self.state_entity)
-      if entity_state in {s.name for s in self.states}:
-        self.current_state = self.states[entity_state]
-      else:
+      self.current_state = self._state_names.get(entity_state)
+      if self.current_state is None:
         self.hass.log(
             'Unrecognized state: {}'.format(entity_state), level='WARNING')
       # Listen for state changes initiated in Home Assistant.
       self.hass.listen_state(self._state_callback, self.state_entity)
 
     if not self.current_state:
-      self.current_state = initial or list(states)[0]
+      self.current_state = initial or next(iter(states))
 
     if self.state_entity:
       self.hass.set_state(self.state_entity, state=self.current_state.name)
 
-    self.on_transition_callback = None
+    self.on_transition_callback = _noop
     self.transitions = defaultdict(list)
+    # Cached outputs of get_dot() and log_graph_link(). Reset when the
+    # transition graph changes.
+    self._dot_cache = None
+    self._dot_link_cache = None
 
   def _state_callback(
       self, unused_entity, unused_attribute, unused_old, new, unused_kwargs):
     """Called on change of the state entity."""
 
+    new_state = self._state_names.get(new)
     # If the state name is not recognized, log a warning.
-    if new not in {s.name for s in self.states}:
+    if new_state is None:
       self.hass.log('Unrecognized state: {}'.format(new), level='WARNING')
       return
-    new_state = self.states[new]
     # No need to do a transition if the state doesn't change.
     if new_state != self.current_state:
       self._perform_transition(Transition(
-          to_state=new_state, trigger=None, on_transition=None))
+          from_state=self.current_state, to_state=new_state, trigger=None,
+          on_transition=_noop))
 
   def _perform_transition(self, transition):
-    """Performs the given state transition."""
+    """Performs the given state transition.
 
-    from_state = self.current_state
-    self.current_state = transition.to_state
-    if self.state_entity:
-      self.hass.set_state(self.state_entity, state=self.current_state.name)
-    # self._start_timer()
-    if transition.on_transition:
+    Keeps performing transitions for as long as a trigger of the new state is
+    already met on entering it. Transitions to a state that was already
+    entered during this call are skipped to avoid looping forever.
+    """
+
+    hass = self.hass
+    state_entity = self.state_entity
+    transitions = self.transitions
+    entered_states = set()
+    while transition is not None:
+      from_state = self.current_state
+      self.current_state = transition.to_state
+      entered_states.add(self.current_state)
+      if state_entity:
+        hass.set_state(state_entity, state=self.current_state.name)
       transition.on_transition()
-    if self.on_transition_callback:
       self.on_transition_callback(from_state, self.current_state)
 
-    for state_transition in self.transitions[from_state]:
-      state_transition.trigger.suspend()
-    for state_transition in self.transitions[self.current_state]:
-      triggered = state_transition.trigger.activate()
-      # Immediately perform another transition if the trigger condition is
-      # already met but only if the transition is to a different state.
-      if triggered and self.current_state != state_transition.to_state:
-        self._perform_transition(state_transition)
-        break
-
-  def _triggered(self, from_state, transition):
+      for state_transition in transitions[from_state]:
+        state_transition.trigger.suspend()
+      transition = None
+      current_state = self.current_state
+      for state_transition in transitions[current_state]:
+        triggered = state_transition.trigger.activate()
+        # Immediately perform another transition if the trigger condition is
+        # already met but only if the transition is to a different state.
+        if triggered and current_state != state_transition.to_state:
+          if state_transition.to_state in entered_states:
+            hass.log(
+                'Transition loop detected: {} -> {}'.format(
+                    current_state.name, state_transition.to_state.name),
+                level='WARNING')
+            continue
+          transition = state_transition
+          break
+
+  def _triggered(self, transition):
     """Called when a trigger has been triggered."""
-    if self.current_state == from_state:
+    if self.current_state == transition.from_state:
       self._perform_transition(transition)
 
   def add_transition(self, from_state, trigger, to_state, on_transition=None):
@@ -263,10 +321,12 @@ class Machine:
     # transition.
     trigger = copy(trigger)
 
-    transition = Transition(trigger, to_state, on_transition)
+    transition = Transition(
+        from_state, trigger, to_state, on_transition or _noop)
     self.transitions[from_state].append(transition)
-    trigger.initialize(
-        self.hass, partial(self._triggered, from_state, transition))
+    self._dot_cache = None
+    self._dot_link_cache = None
+    trigger.initialize(self.hass, partial(self._triggered, transition))
     if self.current_state == from_state:
       triggered = trigger.activate()
       # Immediately perform another transition if the trigger condition is
@@ -286,29 +346,22 @@ class Machine:
       on_transition: Optional callback to call when performing this transition.
     """
 
-    # If it's a single transition, call add_transition().
-    if (from_states != ANY and not isinstance(from_states, list) and
-        not isinstance(triggers, list)):
-      self.add_transition(from_states, triggers, to_state, on_transition)
-      return
-
-    # Add transitions from all states.
-    if from_states == ANY:
-      for state in self.states:
-        self.add_transitions(state, triggers, to_state, on_transition)
-      return
-
-    # Add transitions from a list of states.
-    if isinstance(from_states, list):
-      for state in from_states:
-        self.add_transitions(state, triggers, to_state, on_transition)
-      return
-
-    # Add transitions for a list of triggers.
-    if isinstance(triggers, list):
+    # Normalize both arguments to lists and add every combination.
+    if from_states is ANY:
+      from_states = list(self.states)
+    elif not isinstance(from_states, list):
+      from_states = [from_states]
+    if not isinstance(triggers, list):
+      triggers = [triggers]
+    # Add each transition only once even if a state or a trigger object is
+    # repeated. Triggers are compared by identity.
+    from_states = list(dict.fromkeys(from_states))
+    triggers = list({id(trigger): trigger for trigger in triggers}.values())
+
+    add_transition = self.add_transition
+    for from_state in from_states:
       for trigger in triggers:
-        self.add_transitions(from_states, trigger, to_state, on_transition)
-      return
+        add_transition(from_state, trigger, to_state, on_transition)
 
   def on_transition(self, callback):
     """Sets a callback that will be called on each state transition.
@@ -319,10 +372,18 @@ class Machine:
     Args:
       callback: function taking 2 arguments: (from_state, to_state)
     """
-    self.on_transition_callback = callback
+    self.on_transition_callback = callback or _noop
 
   def get_dot(self):
-    """Returns the transition graph in DOT format."""
+    """Returns the transition graph in DOT format.
+
+    The result is cached and only invalidated by add_transition(), so
+    transitions must only be added through add_transition() or
+    add_transitions(), not by modifying `transitions` directly.
+    """
+
+    if self._dot_cache is not None:
+      return self._dot_cache
 
     edges = defaultdict(list)
     for from_state, transitions in self.transitions.items():
@@ -334,11 +395,19 @@ class Machine:
       dot_edges.append('{}->{}[label="{}"];'.format(
           from_state.name, to_state.name, '\\n'.join(str_triggers)))
 
-    return 'digraph G {{{}}}'.format(''.join(dot_edges))
+    self._dot_cache = 'digraph G {{{}}}'.format(''.join(dot_edges))
+    return self._dot_cache
 
   def log_graph_link(self):
-    """Logs a link to a visualization of the transition graph."""
+    """Logs a link to a visualization of the transition graph.
+
+    The link is cached in the same way as the result of get_dot().
+    """
 
-    link = 'https://dreampuf.github.io/GraphvizOnline/#{}'.format(
-        quote(self.get_dot()))
-    self.hass.log('Transition graph: {}'.format(link))
+    if self._dot_link_cache is None:
+      # Imported here because it is only needed for this debugging helper.
+      from urllib.parse import quote  # pylint: disable=import-outside-toplevel
+      self._dot_link_cache = (
+          'https://dreampuf.github.io/GraphvizOnline/#{}'.format(
+              quote(self.get_dot())))
+    self.hass.log('Transition graph: {}'.format(self._dot_link_cache))
@@ -1,6 +1,6 @@
 #!/usr/bin/python3
 
-from collections import defaultdict, namedtuple
+import heapq
 from enum import Enum
 from unittest import main, TestCase
 from unittest.mock import patch, Mock
@@ -8,26 +8,30 @@ from unittest.mock import patch, Mock
 from machine import Machine, ANY, StateEq, StateNeq, StateOn, StateOff, StateIs, Timeout
 
 
-Timer = namedtuple('Timer', ['call_time', 'callback'])
-
-
 class FakeHass:
   """Class imitating the methods from hassapi.Hass."""
 
   def __init__(self):
-    self.callbacks = defaultdict(list)
+    self.callbacks = {}
     self.entities = {}
     self.current_time = 0
+    # Maps timer keys to callbacks of pending timers.
     self.timers = {}
+    # Heap of (call_time, key) pairs. Cancelled timers are removed from
+    # self.timers and skipped when popped from the heap.
+    self.timer_heap = []
     self.counter = 0
 
   def listen_state(self, callback, entity):
-    self.callbacks[entity].append(callback)
+    self.callbacks.setdefault(entity, []).append(callback)
 
   def set_state(self, entity, state):
     old_state = self.entities.get(entity)
+    # Like Home Assistant, only notify listeners when the state changes.
+    if old_state == state:
+      return
     self.entities[entity] = state
-    for callback in self.callbacks[entity]:
+    for callback in self.callbacks.get(entity, ()):
       callback(entity, None, old_state, state, None)
 
   def get_state(self, entity):
@@ -35,8 +39,9 @@ class FakeHass:
 
   def run_in(self, callback, timeout_sec):
     self.counter += 1
-    self.timers[self.counter] = Timer(
-        self.current_time + timeout_sec, callback)
+    self.timers[self.counter] = callback
+    heapq.heappush(
+        self.timer_heap, (self.current_time + timeout_sec, self.counter))
     return self.counter
 
   def log(self, message, level='INFO'):
@@ -50,13 +55,15 @@ class FakeHass:
 
   def advance_time(self, seconds):
     self.current_time += seconds
-    callbacks_to_run = []
-    for key, timer in self.timers.items():
-      if self.current_time >= timer.call_time:
-        callbacks_to_run.append(key)
-    for key in callbacks_to_run:
-      self.timers[key].callback(None)
-      self.timers.pop(key, None)
+    # Collect due timers first so that timers scheduled by the callbacks only
+    # run on the next call.
+    due_keys = []
+    while self.timer_heap and self.timer_heap[0][0] <= self.current_time:
+      due_keys.append(heapq.heappop(self.timer_heap)[1])
+    for key in due_keys:
+      callback = self.timers.pop(key, None)
+      if callback:
+        callback(None)
 
 
 class States(Enum):
@@ -117,6 +124,14 @@ class MachineTest(TestCase):
     self.hass.advance_time(1)
     self.assertEqual(self.machine.current_state, A)
 
+  def test_zero_timeout_to_self(self):
+    self.machine.add_transition(A, Timeout(0), A)
+    callback = Mock()
+    self.machine.on_transition(callback)
+
+    self.hass.advance_time(1)
+    callback.assert_called_once_with(A, A)
+
   def test_transitions_cancels_timeout(self):
     self.machine.add_transition(A, StateOn('sensor.s'), B)
     self.machine.add_transitions(A, Timeout(10), C)
@@ -205,6 +220,13 @@ class MachineTest(TestCase):
     add_transition.assert_any_call(B, trigger2, C, None)
     self.assertEqual(add_transition.call_count, 4)
 
+  def test_repeated_states_and_triggers(self):
+    trigger = StateOn('sensor.s')
+    with patch.object(self.machine, 'add_transition') as add_transition:
+      self.machine.add_transitions([A, A], [trigger, trigger], B)
+
+    add_transition.assert_called_once_with(A, trigger, B, None)
+
   def test_one_transition_callback(self):
     callback = Mock()
     self.machine.add_transition(A, StateOn('sensor.s'), B, callback)
@@ -235,6 +257,34 @@ class MachineTest(TestCase):
     self.machine.add_transition(A, StateOff('sensor.s'), B)
     self.assertEqual(self.machine.current_state, B)
 
+  def test_immediate_transition_loop(self):
+    """Immediate transitions stop when they would loop back to a state that
+    has already been entered."""
+    self.machine.add_transition(A, StateOn('sensor.s'), B)
+    self.machine.add_transition(B, StateOn('sensor.s'), A)
+
+    with patch.object(self.hass, 'log') as log:
+      self.hass.set_state('sensor.s', 'on')
+    self.assertEqual(self.machine.current_state, A)
+    log.assert_called_once_with(
+        'Transition loop detected: A -> B', level='WARNING')
+
+  def test_long_immediate_transition_chain(self):
+    """Long chains of immediate transitions don't exhaust the stack."""
+    chain_states = Enum('ChainStates', ['S{}'.format(i) for i in range(2000)])
+    machine = Machine(self.hass, chain_states)
+    states = list(chain_states)
+    # Each transition uses its own entity so that a chain broken midway is not
+    # resumed by the callbacks of other triggers.
+    for i, (from_state, to_state) in enumerate(zip(states, states[1:])):
+      if i > 0:
+        self.hass.set_state('sensor.c{}'.format(i), 'on')
+      machine.add_transition(
+          from_state, StateOn('sensor.c{}'.format(i)), to_state)
+
+    self.hass.set_state('sensor.c0', 'on')
+    self.assertEqual(machine.current_state, states[-1])
+
   def test_lambda_state_trigger(self):
     self.machine.add_transition(
         A, StateIs('sensor.i', lambda v: int(v) > 5), B)
@@ -246,6 +296,16 @@ class MachineTest(TestCase):
     self.hass.set_state('sensor.i', '6')
     self.assertEqual(self.machine.current_state, B)
 
+  def test_get_dot(self):
+    self.machine.add_transition(A, StateOn('sensor.s'), B)
+    self.assertEqual(self.machine.get_dot(),
+                     'digraph G {A->B[label="sensor.s"];}')
+
+    self.machine.add_transition(B, Timeout(10), A)
+    self.assertEqual(
+        self.machine.get_dot(),
+        'digraph G {A->B[label="sensor.s"];B->A[label="timeout 10 s"];}')
+
 
 if __name__ == '__main__':
   main()